@@ -14,8 +14,12 @@ import torch
 
 # Range of torch.rand() is [0,1)
 # Range of torch.rand() * 2 - 1 is [-1, 1), includes negative values
-def make_rand_torch(shape: list[int], dtype: Optional[torch.dtype] = torch.float32):
-    return (torch.rand(shape) * 2 - 1).to(dtype=dtype)
+def make_rand_torch(
+    shape: list[int],
+    dtype: Optional[torch.dtype] = torch.float32,
+    generator: Optional[torch.Generator] = None,
+):
+    return (torch.rand(shape, generator=generator) * 2 - 1).to(dtype=dtype)
 
 
 def make_random_mask(shape: tuple[int], dtype: Optional[torch.dtype] = None):
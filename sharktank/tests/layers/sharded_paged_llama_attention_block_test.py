@@ -4,7 +4,9 @@
 # See https://llvm.org/LICENSE.txt for license information.
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 
-import unittest
+"""Verify that the sharded Llama paged attention block behaves in PyTorch as the
+unsharded variant."""
+
 from sharktank.layers import (
     PagedLlamaAttentionBlock,
     PagedAttention,
@@ -12,190 +14,233 @@ from sharktank.layers import (
 )
 from sharktank.layers.testing import make_llama_attention_block_theta
 from sharktank.types.sharding import PagedLlamaAttentionBlockSharding
-from sharktank.types import SplitPrimitiveTensor, unbox_tensor
-from sharktank.utils.misc import iterables_equal
+from sharktank.types import SplitPrimitiveTensor, Theta, unbox_tensor
 from sharktank.utils.random import make_rand_torch
 import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from sharktank import ops
-from copy import deepcopy
 import pytest
 import platform
 
+MODEL_ARCH = "llama"
+TRANSFORMER_BLOCK_COUNT = 13
+BLOCK_INDEX = 1
+SHARD_COUNT = 3
+HEAD_COUNT_KV = 2 * SHARD_COUNT
+ATTENTION_HEAD_COUNT = 5 * HEAD_COUNT_KV
+ATTENTION_HEAD_DIM = 11 * 2
+RMS_EPSILON = 0.01
+BLOCK_SEQ_STRIDE = 17
+CACHE_PARTITION_COUNT = 2
+PAGE_COUNT = 23
+EMBEDDING_LENGTH = ATTENTION_HEAD_COUNT * ATTENTION_HEAD_DIM
+ROPE_DIMENSION_COUNT = ATTENTION_HEAD_DIM
+BLOCK_SEQLEN = 7
+MAX_SEQLEN = BLOCK_SEQ_STRIDE * BLOCK_SEQLEN
+ROPE_FREQ_BASE = None
+BATCH_SIZE = 3
+START_INDEX = 0
+
+
+# The fixtures below are dtype-independent and shared by all parametrizations.
+
+
+@pytest.fixture(scope="module")
+def seq_block_ids() -> torch.Tensor:
+    return torch.arange(BATCH_SIZE * BLOCK_SEQLEN, dtype=torch.int64).reshape(
+        BATCH_SIZE, BLOCK_SEQLEN
+    )
+
 
-class ShardedPagedLlamaAttentionBlockTest(unittest.TestCase):
-    """Verify that the sharded Llama paged attention block behaves in PyTorch as the
-    unsharded variant."""
+@pytest.fixture(scope="module")
+def sharded_seq_block_ids(seq_block_ids: torch.Tensor):
+    return ops.replicate(seq_block_ids, count=SHARD_COUNT)
 
-    def setUp(self):
-        torch.manual_seed(12345)
-        self.model_arch = "llama"
-        self.transformer_block_count = 13
-        self.block_index = 1
-        self.shard_count = 3
-        self.head_count_kv = 2 * self.shard_count
-        self.attention_head_count = 5 * self.head_count_kv
-        self.attention_head_dim = 11 * 2
-        self.rms_epsilon = 0.01
-        self.block_seq_stride = 17
-        self.cache_partition_count = 2
-        self.page_count = 23
-        self.embedding_length = self.attention_head_count * self.attention_head_dim
-        self.rope_dimension_count = self.attention_head_dim
-        self.block_seqlen = 7
-        self.max_seqlen = self.block_seq_stride * self.block_seqlen
-        self.rope_freq_base = None
-        self.batch_size = 3
-        self.start_index = 0
-
-    @pytest.mark.xfail(
-        platform.system() == "Windows",
-        raises=AssertionError,
-        strict=False,
-        reason="nan on Windows",
+
+@pytest.fixture(scope="module")
+def embedding_module():
+    return build_rotary_layer(
+        rope_dimension_count=ROPE_DIMENSION_COUNT,
+        rope_freq_base=ROPE_FREQ_BASE,
     )
-    def testSmallSizedLayerFp64(self):
-        self.runTestSmallSizedLayer(dtype=torch.float64, rtol=1e-7, atol=1e-7)
 
-    def testSmallSizedLayerFp32(self):
-        # This tolerance is OK because the output element value range is (-538, 582).
-        self.runTestSmallSizedLayer(dtype=torch.float32, rtol=1e-5, atol=1e-2)
-
-    def runTestSmallSizedLayer(self, dtype: torch.dtype, rtol: float, atol: float):
-        torch.set_default_dtype(dtype)
-
-        def make_paged_kv_cache(shard_count: int) -> PagedAttention:
-            return PagedAttention(
-                transformer_block_count=self.transformer_block_count,
-                attn_head_count=self.head_count_kv,
-                attn_head_dim=self.attention_head_dim,
-                cache_partition_count=self.cache_partition_count,
-                block_seq_stride=self.block_seq_stride,
-                cache_dtype=dtype,
-                attn_dtype=dtype,
-                shard_count=shard_count,
-            )
-
-        cache = make_paged_kv_cache(shard_count=1)
-        sharded_cache = make_paged_kv_cache(shard_count=self.shard_count)
-
-        def assert_equal_unsharded_and_sharded_cache_states(
-            cache_state: list[torch.Tensor],
-            sharded_cache_state: list[SplitPrimitiveTensor],
-        ):
-            cache_state = cache.unshard_state(cache_state)[0]
-            sharded_state_as_unsharded = sharded_cache.unshard_state(
-                sharded_cache_state
-            )[0]
-            assert iterables_equal(sharded_state_as_unsharded.shape, cache_state.shape)
-            assert ops.equal(
-                cache_state,
-                sharded_state_as_unsharded,
-            )
-
-        def assert_close_unsharded_and_sharded_cache_states(
-            cache_state: list[torch.Tensor],
-            sharded_cache_state: list[SplitPrimitiveTensor],
-        ):
-            cache_state = cache.unshard_state(cache_state)[0]
-            sharded_state_as_unsharded = sharded_cache.unshard_state(
-                sharded_cache_state
-            )[0]
-            assert iterables_equal(sharded_state_as_unsharded.shape, cache_state.shape)
-            torch.testing.assert_close(
-                unbox_tensor(cache_state),
-                unbox_tensor(sharded_state_as_unsharded),
-                rtol=rtol,
-                atol=atol,
-            )
-
-        def make_unsharded_and_sharded_equal_cache_states() -> (
-            tuple[list[torch.Tensor], list[SplitPrimitiveTensor]]
-        ):
-            cache_state = cache.allocate(self.page_count)
-            cache_state[0] = make_rand_torch(cache_state[0].shape, dtype=dtype)
-            sharded_cache_state = sharded_cache.shard_state(deepcopy(cache_state))
-            assert_equal_unsharded_and_sharded_cache_states(
-                cache_state, sharded_cache_state
-            )
-            return cache_state, sharded_cache_state
-
-        (
-            cache_state,
-            sharded_cache_state,
-        ) = make_unsharded_and_sharded_equal_cache_states()
-
-        input_tensor = make_rand_torch(
-            (
-                self.batch_size,
-                self.max_seqlen,
-                self.attention_head_count * self.attention_head_dim,
-            ),
-            dtype=dtype,
+
+@pytest.fixture(scope="module")
+def sharded_embedding_module():
+    return build_rotary_layer(
+        rope_dimension_count=ROPE_DIMENSION_COUNT,
+        rope_freq_base=ROPE_FREQ_BASE,
+        tensor_parallelism_size=SHARD_COUNT,
+    )
+
+
+@pytest.fixture(scope="module")
+def master_input() -> torch.Tensor:
+    # Generated once in the widest dtype and cast down per test.
+    return make_rand_torch(
+        (BATCH_SIZE, MAX_SEQLEN, ATTENTION_HEAD_COUNT * ATTENTION_HEAD_DIM),
+        dtype=torch.float64,
+        generator=torch.Generator().manual_seed(12345),
+    )
+
+
+@pytest.fixture(scope="module")
+def theta() -> Theta:
+    with torch.random.fork_rng():
+        torch.manual_seed(12345)
+        return make_llama_attention_block_theta(
+            block_idx=0,
+            head_count=ATTENTION_HEAD_COUNT,
+            head_count_kv=HEAD_COUNT_KV,
+            head_dim=ATTENTION_HEAD_DIM,
+            embedding_length=EMBEDDING_LENGTH,
         )
-        seq_block_ids = torch.arange(self.batch_size * self.block_seqlen).view(
-            self.batch_size, -1
+
+
+@pytest.fixture(scope="module")
+def sharded_theta(theta: Theta) -> Theta:
+    theta_sharding = PagedLlamaAttentionBlockSharding(shard_count=SHARD_COUNT)
+    return ops.reshard(theta, theta_sharding)
+
+
+@pytest.mark.parametrize(
+    "dtype, rtol, atol",
+    [
+        pytest.param(
+            torch.float64,
+            1e-7,
+            1e-7,
+            marks=pytest.mark.xfail(
+                platform.system() == "Windows",
+                raises=AssertionError,
+                strict=False,
+                reason="nan on Windows",
+            ),
+        ),
+        # This tolerance is OK because the output element value range is (-538, 582).
+        (torch.float32, 1e-5, 1e-2),
+    ],
+)
+@torch.no_grad()
+def test_sharded_paged_llama_attention_block_small_sized_layer(
+    dtype: torch.dtype,
+    rtol: float,
+    atol: float,
+    seq_block_ids: torch.Tensor,
+    sharded_seq_block_ids,
+    embedding_module,
+    sharded_embedding_module,
+    master_input: torch.Tensor,
+    theta: Theta,
+    sharded_theta: Theta,
+):
+    generator = torch.Generator().manual_seed(12345)
+
+    def make_paged_kv_cache(shard_count: int) -> PagedAttention:
+        return PagedAttention(
+            transformer_block_count=TRANSFORMER_BLOCK_COUNT,
+            attn_head_count=HEAD_COUNT_KV,
+            attn_head_dim=ATTENTION_HEAD_DIM,
+            cache_partition_count=CACHE_PARTITION_COUNT,
+            block_seq_stride=BLOCK_SEQ_STRIDE,
+            cache_dtype=dtype,
+            attn_dtype=dtype,
+            shard_count=shard_count,
         )
-        embedding_module = build_rotary_layer(
-            rope_dimension_count=self.rope_dimension_count,
-            rope_freq_base=self.rope_freq_base,
+
+    cache = make_paged_kv_cache(shard_count=1)
+    sharded_cache = make_paged_kv_cache(shard_count=SHARD_COUNT)
+
+    def assert_equal_unsharded_and_sharded_cache_states(
+        cache_state: list[torch.Tensor],
+        sharded_cache_state: list[SplitPrimitiveTensor],
+    ):
+        cache_state = cache.unshard_state(cache_state)[0]
+        sharded_state_as_unsharded = sharded_cache.unshard_state(sharded_cache_state)[0]
+        assert tuple(sharded_state_as_unsharded.shape) == tuple(cache_state.shape)
+        assert torch.equal(
+            unbox_tensor(cache_state), unbox_tensor(sharded_state_as_unsharded)
         )
 
-        theta = make_llama_attention_block_theta(
-            block_idx=0,
-            head_count=self.attention_head_count,
-            head_count_kv=self.head_count_kv,
-            head_dim=self.attention_head_dim,
-            embedding_length=self.embedding_length,
+    def assert_close_unsharded_and_sharded_cache_states(
+        cache_state: list[torch.Tensor],
+        sharded_cache_state: list[SplitPrimitiveTensor],
+    ):
+        cache_state = cache.unshard_state(cache_state)[0]
+        sharded_state_as_unsharded = sharded_cache.unshard_state(sharded_cache_state)[0]
+        assert tuple(sharded_state_as_unsharded.shape) == tuple(cache_state.shape)
+        torch.testing.assert_close(
+            unbox_tensor(cache_state),
+            unbox_tensor(sharded_state_as_unsharded),
+            rtol=rtol,
+            atol=atol,
         )
-        attention_block = PagedLlamaAttentionBlock(
-            theta=theta,
-            block_index=self.block_index,
-            cache=cache,
-            head_count=self.attention_head_count,
-            head_dim=self.attention_head_dim,
-            head_count_kv=self.head_count_kv,
-            rms_epsilon=self.rms_epsilon,
-            model_arch=self.model_arch,
+
+    def make_unsharded_and_sharded_equal_cache_states() -> (
+        tuple[list[torch.Tensor], list[SplitPrimitiveTensor]]
+    ):
+        cache_state = cache.allocate(PAGE_COUNT)
+        # Fill the freshly allocated page slab in place, with the same
+        # [-1, 1) range as make_rand_torch.
+        cache_state[0].uniform_(-1, 1, generator=generator)
+        # Sharding slices the head dimension out of each page and flattens it,
+        # which already copies, so the sharded state never aliases cache_state.
+        sharded_cache_state = sharded_cache.shard_state(cache_state)
+        assert_equal_unsharded_and_sharded_cache_states(
+            cache_state, sharded_cache_state
         )
+        return cache_state, sharded_cache_state
+
+    (
+        cache_state,
+        sharded_cache_state,
+    ) = make_unsharded_and_sharded_equal_cache_states()
+
+    input_tensor = master_input.to(dtype)
+
+    attention_block = PagedLlamaAttentionBlock(
+        theta=theta,
+        block_index=BLOCK_INDEX,
+        cache=cache,
+        head_count=ATTENTION_HEAD_COUNT,
+        head_dim=ATTENTION_HEAD_DIM,
+        head_count_kv=HEAD_COUNT_KV,
+        rms_epsilon=RMS_EPSILON,
+        model_arch=MODEL_ARCH,
+    )
+    # Use the fused attention kernel instead of the math decomposition.
+    # On CPU the flash kernel covers both fp32 and fp64.
+    with sdpa_kernel(SDPBackend.FLASH_ATTENTION):
         expected_result = attention_block(
             input_tensor,
             embedding=embedding_module,
             seq_block_ids=seq_block_ids,
-            start_index=self.start_index,
+            start_index=START_INDEX,
             cache_state=cache_state,
         )
 
-        sharded_input_tensor = ops.replicate(input_tensor, count=self.shard_count)
-        sharded_seq_block_ids = ops.replicate(seq_block_ids, count=self.shard_count)
-        sharded_embedding_module = build_rotary_layer(
-            rope_dimension_count=self.rope_dimension_count,
-            rope_freq_base=self.rope_freq_base,
-            tensor_parallelism_size=self.shard_count,
-        )
-
-        theta_sharding = PagedLlamaAttentionBlockSharding(shard_count=self.shard_count)
-        sharded_theta = ops.reshard(theta, theta_sharding)
-        sharded_attention_block = PagedLlamaAttentionBlock(
-            theta=sharded_theta,
-            block_index=self.block_index,
-            cache=sharded_cache,
-            head_count=self.attention_head_count,
-            head_dim=self.attention_head_dim,
-            head_count_kv=self.head_count_kv,
-            rms_epsilon=self.rms_epsilon,
-            model_arch=self.model_arch,
-        )
+    sharded_input_tensor = ops.replicate(input_tensor, count=SHARD_COUNT)
+
+    sharded_attention_block = PagedLlamaAttentionBlock(
+        theta=sharded_theta,
+        block_index=BLOCK_INDEX,
+        cache=sharded_cache,
+        head_count=ATTENTION_HEAD_COUNT,
+        head_dim=ATTENTION_HEAD_DIM,
+        head_count_kv=HEAD_COUNT_KV,
+        rms_epsilon=RMS_EPSILON,
+        model_arch=MODEL_ARCH,
+    )
+    with sdpa_kernel(SDPBackend.FLASH_ATTENTION):
         sharded_result = sharded_attention_block(
             sharded_input_tensor,
             embedding=sharded_embedding_module,
             seq_block_ids=sharded_seq_block_ids,
-            start_index=self.start_index,
+            start_index=START_INDEX,
             cache_state=sharded_cache_state,
         )
 
-        actual_result = unbox_tensor(ops.unshard(sharded_result))
+    actual_result = unbox_tensor(ops.unshard(sharded_result))
 
-        torch.testing.assert_close(actual_result, expected_result, rtol=rtol, atol=atol)
-        assert_close_unsharded_and_sharded_cache_states(
-            cache_state, sharded_cache_state
-        )
+    torch.testing.assert_close(actual_result, expected_result, rtol=rtol, atol=atol)
+    assert_close_unsharded_and_sharded_cache_states(cache_state, sharded_cache_state)
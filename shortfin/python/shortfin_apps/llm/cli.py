@@ -283,13 +283,16 @@ async def main(argv):
     service = lifecycle_manager.services["default"]
     service.start()
 
-    sampling_params = SamplingParams(max_completion_tokens=args.decode_steps)
+    # Pass everything at construction so `SamplingParams.__post_init__` can
+    # clamp values and record which of them were provided.
+    sampling_kwargs = {"max_completion_tokens": args.decode_steps}
     if getattr(args, "temperature", None) is not None:
-        sampling_params.temperature = args.temperature
+        sampling_kwargs["temperature"] = args.temperature
     if getattr(args, "top_k", None) is not None:
-        sampling_params.top_k = args.top_k
+        sampling_kwargs["top_k"] = args.top_k
     if getattr(args, "top_p", None) is not None:
-        sampling_params.top_p = args.top_p
+        sampling_kwargs["top_p"] = args.top_p
+    sampling_params = SamplingParams(**sampling_kwargs)
 
     prompts = process_inputs(args)
 
@@ -13,7 +13,8 @@ sglang: Copyright 2023-2024 SGLang Team, Licensed under the Apache License, Vers
 
 from dataclasses import dataclass, field
 from typing import List, Optional, Union
-import uuid
+from pydantic.json_schema import SkipJsonSchema
+import secrets
 
 # TODO: Should max, min, and default change based on the model being ran?
 # Source: https://github.com/ggml-org/llama.cpp/blob/master/examples/main/README.md?#temperature
@@ -32,16 +33,56 @@ The reason for this, instead of using `None`, is to allow for the distinction
 between a value that was explicitly set to `None` and a value that was not provided.
 
 This prevents confusion in cases where `None` indicates something functional
-for some params, like disabling `top_k` or `top_p` sampling if set to None,
-versus other cases where `None` indicates that we should use the server default.
+for some params versus other cases where `None` indicates that we should use
+the server default. For `top_k` and `top_p`, where an explicit `None` disables
+that sampling, `SamplingParams.__post_init__` records whether a value was
+provided in `top_k_set`/`top_p_set` and replaces the sentinel with `None`.
 
 This allows us to still generically load from these fields in `DecodeConfig`,
 without specific logic as well.
+
+It is a singleton, so checks are identity comparisons (`is NOT_PROVIDED`) and
+can never collide with a user supplied value.
 """
-NOT_PROVIDED = "NOT_PROVIDED"
 
 
-@dataclass
+class _NotProvided:
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "NOT_PROVIDED"
+
+    def __reduce__(self) -> str:
+        # Keep the singleton identity across copy/deepcopy/pickle.
+        return "NOT_PROVIDED"
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source_type, handler):
+        # Lets pydantic serialize the sentinel when it is a field default, so
+        # the `/generate` OpenAPI schema keeps documenting it as "NOT_PROVIDED".
+        from pydantic_core import core_schema
+
+        return core_schema.is_instance_schema(
+            cls, serialization=core_schema.plain_serializer_function_ser_schema(repr)
+        )
+
+
+NOT_PROVIDED = _NotProvided()
+
+
+def _broadcast(value, default, num: int) -> list:
+    """Expand a per-request `value` to a list of `num` entries.
+
+    `None` is replaced by `default`. Lists are returned unchanged.
+    """
+    if value is None:
+        return [default] * num
+    if isinstance(value, list):
+        return value
+    return [value] * num
+
+
+@dataclass(slots=True)
 class SamplingParams:
     # Number of parallel samples
     n: int = 1
@@ -49,10 +90,14 @@ class SamplingParams:
     max_completion_tokens: int = DEFAULT_MAX_COMPLETION_TOKENS
     # Temperature to use during generation
     temperature: float = DEFAULT_TEMPERATURE
-    # Use `top_k` sampling during token selection process
-    top_k: int = NOT_PROVIDED
-    # Use `top_p` sampling during token selection process
-    top_p: float = NOT_PROVIDED
+    # Use `top_k` sampling during token selection process, `None` disables it
+    top_k: Optional[int] = NOT_PROVIDED
+    # Use `top_p` sampling during token selection process, `None` disables it
+    top_p: Optional[float] = NOT_PROVIDED
+    # Whether `top_k`/`top_p` were provided. Derived in `__post_init__`, not
+    # part of the request body.
+    top_k_set: SkipJsonSchema[bool] = field(default=False, init=False)
+    top_p_set: SkipJsonSchema[bool] = field(default=False, init=False)
     # Number of beams to use during generation
     num_beams: int = NOT_PROVIDED
     # Whether to use beam search during generation
@@ -61,13 +106,19 @@ class SamplingParams:
     def __post_init__(self):
         # Ensure temperature is within acceptable range
         self.temperature = min(MAX_TEMPERATURE, max(self.temperature, MIN_TEMPERATURE))
-        if self.top_p != NOT_PROVIDED:
+        self.top_k_set = self.top_k is not NOT_PROVIDED
+        if not self.top_k_set:
+            self.top_k = None
+        self.top_p_set = self.top_p is not NOT_PROVIDED
+        if not self.top_p_set:
+            self.top_p = None
+        if self.top_p is not None:
             self.top_p = min(MAX_TOP_P, max(self.top_p, MIN_TOP_P))
 
 
 # Adapted from:
 # https://github.com/sgl-project/sglang/blob/main/python/sglang/srt/managers/io_struct.py
-@dataclass
+@dataclass(slots=True)
 class GenerateReqInput:
     # The input prompt. It can be a single prompt or a batch of prompts.
     text: Optional[Union[List[str], str]] = None
@@ -98,6 +149,9 @@ class GenerateReqInput:
     modalities: Optional[List[str]] = None
 
     is_single: bool = True
+    # Populated by `post_init` for batched requests. Not part of the request body.
+    parallel_sample_num: SkipJsonSchema[int] = field(default=0, init=False)
+    batch_size: SkipJsonSchema[int] = field(default=0, init=False)
 
     def post_init(self):
         if (self.text is None and self.input_ids is None) or (
@@ -115,7 +169,7 @@ class GenerateReqInput:
 
         if is_single:
             if self.rid is None:
-                self.rid = uuid.uuid4().hex
+                self.rid = secrets.token_hex(16)
             if self.return_logprob is None:
                 self.return_logprob = False
             if self.logprob_start_len is None:
@@ -123,19 +177,17 @@ class GenerateReqInput:
             if self.top_logprobs_num is None:
                 self.top_logprobs_num = 0
         else:
-            parallel_sample_num_list = []
             sampling_params = self.sampling_params
             if isinstance(sampling_params, SamplingParams):
                 parallel_sample_num = sampling_params.n
             elif isinstance(sampling_params, list):
+                # Track the max and whether all values agree in a single pass.
+                parallel_sample_num = sampling_params[0].n if sampling_params else 1
+                all_equal = True
                 for sp in sampling_params:
-                    parallel_sample_num = sp.n
-                    parallel_sample_num_list.append(parallel_sample_num)
-                parallel_sample_num = max(parallel_sample_num_list)
-                all_equal = all(
-                    element == parallel_sample_num
-                    for element in parallel_sample_num_list
-                )
+                    if sp.n != parallel_sample_num:
+                        all_equal = False
+                        parallel_sample_num = max(parallel_sample_num, sp.n)
                 if parallel_sample_num > 1 and (not all_equal):
                     # TODO cope with the case that the parallel_sample_num is different for different samples
                     raise ValueError(
@@ -164,48 +216,32 @@ class GenerateReqInput:
                 num = len(self.text) if self.text is not None else len(self.input_ids)
                 self.batch_size = num
 
-            if self.image_data is None:
-                self.image_data = [None] * num
-            elif not isinstance(self.image_data, list):
-                self.image_data = [self.image_data] * num
-
-            if not isinstance(self.sampling_params, list):
-                self.sampling_params = [self.sampling_params] * num
+            self.image_data = _broadcast(self.image_data, None, num)
+            self.sampling_params = _broadcast(self.sampling_params, None, num)
 
             if self.rid is None:
-                self.rid = [uuid.uuid4().hex for _ in range(num)]
+                self.rid = [secrets.token_hex(16) for _ in range(num)]
             else:
                 if not isinstance(self.rid, list):
                     raise ValueError("The rid should be a list.")
 
-            if self.return_logprob is None:
-                self.return_logprob = [False] * num
-            elif not isinstance(self.return_logprob, list):
-                self.return_logprob = [self.return_logprob] * num
-
-            if self.logprob_start_len is None:
-                self.logprob_start_len = [-1] * num
-            elif not isinstance(self.logprob_start_len, list):
-                self.logprob_start_len = [self.logprob_start_len] * num
-
-            if self.top_logprobs_num is None:
-                self.top_logprobs_num = [0] * num
-            elif not isinstance(self.top_logprobs_num, list):
-                self.top_logprobs_num = [self.top_logprobs_num] * num
+            self.return_logprob = _broadcast(self.return_logprob, False, num)
+            self.logprob_start_len = _broadcast(self.logprob_start_len, -1, num)
+            self.top_logprobs_num = _broadcast(self.top_logprobs_num, 0, num)
 
 
-@dataclass
+@dataclass(slots=True)
 class GeneratedResponse:
     text: str
 
 
-@dataclass
+@dataclass(slots=True)
 class PromptResponse:
     prompt: str
 
     responses: list[GeneratedResponse]
 
 
-@dataclass
+@dataclass(slots=True)
 class GenerateReqOutput:
     responses: list[PromptResponse]
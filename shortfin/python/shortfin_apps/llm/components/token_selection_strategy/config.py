@@ -84,10 +84,15 @@ class DecodeConfig:
 
     def update_from_sampling_params(self, sampling_params):
         for field in fields(sampling_params):
-            if getattr(sampling_params, field.name) == NOT_PROVIDED:
+            value = getattr(sampling_params, field.name)
+            if value is NOT_PROVIDED:
+                continue
+            # Fields such as `top_k` record whether they were provided in a
+            # companion `<name>_set` flag.
+            if not getattr(sampling_params, f"{field.name}_set", True):
                 continue
             if hasattr(self, field.name):
-                setattr(self, field.name, getattr(sampling_params, field.name))
+                setattr(self, field.name, value)
 
 
 @dataclass
@@ -0,0 +1,153 @@
+# Copyright 2025 Advanced Micro Devices, Inc.
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+from copy import deepcopy
+from fastapi import FastAPI
+from pydantic import TypeAdapter
+import pytest
+import warnings
+
+from shortfin_apps.llm.components.io_struct import (
+    GenerateReqInput,
+    MAX_TOP_P,
+    NOT_PROVIDED,
+    SamplingParams,
+)
+from shortfin_apps.llm.components.token_selection_strategy.config import DecodeConfig
+
+
+def _openapi_schemas() -> dict:
+    app = FastAPI()
+
+    @app.post("/generate")
+    def generate(gen_req: GenerateReqInput):
+        pass
+
+    return app.openapi()["components"]["schemas"]
+
+
+def test_generate_req_input_single():
+    gen_req = GenerateReqInput(text="hello")
+    gen_req.post_init()
+
+    assert gen_req.is_single
+    assert isinstance(gen_req.rid, str) and len(gen_req.rid) == 32
+    assert gen_req.return_logprob is False
+    assert gen_req.logprob_start_len == -1
+    assert gen_req.top_logprobs_num == 0
+
+
+def test_generate_req_input_batch_broadcast():
+    sampling_params = SamplingParams()
+    gen_req = GenerateReqInput(
+        text=["hello", "world", "!"],
+        sampling_params=sampling_params,
+        logprob_start_len=4,
+    )
+    gen_req.post_init()
+
+    assert not gen_req.is_single
+    assert gen_req.parallel_sample_num == 1
+    assert gen_req.batch_size == 3
+    assert gen_req.image_data == [None] * 3
+    assert gen_req.sampling_params == [sampling_params] * 3
+    assert len(gen_req.rid) == 3 and len(set(gen_req.rid)) == 3
+    assert gen_req.return_logprob == [False] * 3
+    assert gen_req.logprob_start_len == [4] * 3
+    assert gen_req.top_logprobs_num == [0] * 3
+
+
+def test_generate_req_input_parallel_samples():
+    gen_req = GenerateReqInput(
+        text=["hello", "world"],
+        sampling_params=[SamplingParams(n=2), SamplingParams(n=2)],
+    )
+    gen_req.post_init()
+
+    assert gen_req.parallel_sample_num == 2
+    assert gen_req.batch_size == 2
+    # Each prompt gets its parallel samples plus the original prefill.
+    assert len(gen_req.rid) == (2 + 1) * 2
+
+
+def test_generate_req_input_internal_fields_not_in_request_body():
+    properties = _openapi_schemas()["GenerateReqInput"]["properties"]
+    assert "parallel_sample_num" not in properties
+    assert "batch_size" not in properties
+
+    gen_req = TypeAdapter(GenerateReqInput).validate_python(
+        {"text": "hello", "parallel_sample_num": 3, "batch_size": 7}
+    )
+    gen_req.post_init()
+    assert gen_req.parallel_sample_num == 0
+    assert gen_req.batch_size == 0
+
+
+def test_generate_req_input_mismatched_parallel_samples():
+    gen_req = GenerateReqInput(
+        text=["hello", "world"],
+        sampling_params=[SamplingParams(n=1), SamplingParams(n=2)],
+    )
+    with pytest.raises(ValueError):
+        gen_req.post_init()
+
+
+def test_sampling_params_not_provided_sentinel():
+    sampling_params = SamplingParams()
+    assert sampling_params.num_beams is NOT_PROVIDED
+    assert sampling_params.use_beam_search is NOT_PROVIDED
+    # Identity must survive copies of the params.
+    assert deepcopy(sampling_params).num_beams is NOT_PROVIDED
+    # A user supplied string is a real value, not the sentinel.
+    assert SamplingParams(num_beams="NOT_PROVIDED").num_beams is not NOT_PROVIDED
+
+
+def test_sampling_params_openapi_schema():
+    with warnings.catch_warnings():
+        # Pydantic warns and drops defaults it cannot serialize.
+        warnings.simplefilter("error")
+        properties = _openapi_schemas()["SamplingParams"]["properties"]
+    assert properties["num_beams"]["default"] == "NOT_PROVIDED"
+    assert properties["use_beam_search"]["default"] == "NOT_PROVIDED"
+
+
+def test_sampling_params_top_k_top_p_set():
+    sampling_params = SamplingParams()
+    assert sampling_params.top_k is None and not sampling_params.top_k_set
+    assert sampling_params.top_p is None and not sampling_params.top_p_set
+
+    sampling_params = SamplingParams(top_k=10, top_p=1.0)
+    assert sampling_params.top_k == 10 and sampling_params.top_k_set
+    assert sampling_params.top_p == MAX_TOP_P and sampling_params.top_p_set
+
+    # Explicitly disabling `top_k` is still distinguishable from not setting it.
+    sampling_params = SamplingParams(top_k=None)
+    assert sampling_params.top_k is None and sampling_params.top_k_set
+    assert sampling_params.top_p is None and not sampling_params.top_p_set
+
+
+def test_sampling_params_top_k_top_p_from_request_body():
+    properties = _openapi_schemas()["SamplingParams"]["properties"]
+    assert "top_k_set" not in properties
+    assert "top_p_set" not in properties
+
+    gen_req = TypeAdapter(GenerateReqInput).validate_python(
+        {"text": "hello", "sampling_params": {"top_k": None}}
+    )
+    assert gen_req.sampling_params.top_k is None
+    assert gen_req.sampling_params.top_k_set
+    assert not gen_req.sampling_params.top_p_set
+
+
+def test_decode_config_update_from_sampling_params():
+    decode_config = DecodeConfig(top_k=5, top_p=0.5)
+    decode_config.update_from_sampling_params(SamplingParams(top_p=0.9))
+    assert decode_config.top_k == 5
+    assert decode_config.top_p == 0.9
+
+    decode_config.update_from_sampling_params(SamplingParams(top_k=None))
+    assert decode_config.top_k is None
+    assert decode_config.top_p == 0.9